@@ -1,24 +1,54 @@
 # main.py
 from __future__ import annotations
 
+import asyncio
+import contextvars
+import logging
+import os
 import re
 import shutil
-import subprocess
 import tempfile
 import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Optional, Tuple, Dict
-
+from typing import Optional, Tuple, Dict, List, Set
+from urllib.parse import quote
+from zipfile import ZipFile, ZIP_STORED
+
+# Pesos do Demucs (torch.hub), cache de stems e workdirs num diretório persistente; em Docker,
+# monte um volume aqui ou defina STEMS_CACHE_DIR (ou só TORCH_HOME) para reaproveitar o cache
+# entre containers ou apontar para um disco gravável.
+APP_CACHE_DIR = Path(os.environ.get("STEMS_CACHE_DIR") or Path(__file__).parent.resolve() / ".cache")
+os.environ.setdefault("TORCH_HOME", str(APP_CACHE_DIR / "torch"))
+
+import aiofiles
+import blake3
 import gradio as gr
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException, BackgroundTasks
-from fastapi.responses import FileResponse, HTMLResponse
+import torch
+import torch.nn.functional as F
+from demucs import pretrained
+from demucs.apply import BagOfModels, apply_model
+from demucs.audio import AudioFile, save_audio
+from demucs.htdemucs import HTDemucs
+from fastapi import FastAPI, UploadFile, File, Form, BackgroundTasks
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
+from starlette.concurrency import run_in_threadpool
 from starlette.middleware.cors import CORSMiddleware
+from zipstream import ZipStream
+
+try:
+    from torchaudio.io import StreamReader
+except ImportError:  # torchaudio sem suporte a FFmpeg
+    StreamReader = None
 
 # ============================
 # Static & App bootstrap
 # ============================
 
+logger = logging.getLogger(__name__)
+
 BASE_DIR = Path(__file__).parent.resolve()
 STATIC_DIR = BASE_DIR / "static"
 STATIC_DIR.mkdir(exist_ok=True)  # garante a pasta
@@ -37,99 +67,273 @@ DEMUCS_MODELS = [
     "mdx_extra",
 ]
 STEM_KEYS = ["vocals", "drums", "bass", "other"]
+STEM_EXT = ".flac"  # sem perdas e já comprimido: o ZIP não precisa recomprimir
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB
+# Workers do apply_model na CPU (metade dos núcleos, sobra folga para ffmpeg/uvicorn)
+CPU_JOBS = max(1, (os.cpu_count() or 2) // 2)
+# Inferências simultâneas (API + Gradio). Na CPU o paralelismo já vem de CPU_JOBS;
+# threads (e não processos) para compartilhar os modelos em MODELS e a GPU.
+SEPARATE_WORKERS = 1
+SEPARATE_POOL = ThreadPoolExecutor(max_workers=SEPARATE_WORKERS, thread_name_prefix="demucs")
 
 def ensure_ffmpeg_in_path() -> bool:
     return shutil.which("ffmpeg") is not None
 
+_SLUG_STRIP = re.compile(r"[^\w\s-]")
+_SLUG_DASH = re.compile(r"[-\s]+")
+# Nomes que o caminho lento devolveria sem alterações (sem "--" nem "-"/"_" nas pontas)
+_SLUG_FAST = re.compile(r"[a-z0-9]+(?:(?:_+-?_*|-_*)[a-z0-9]+)*")
+
 def slugify_basename(name: str, default: str = "input") -> str:
-    base = Path(name).stem
-    base = base.lower()
-    base = re.sub(r"[^\w\s-]", "", base)
-    base = re.sub(r"[-\s]+", "-", base).strip("-_")
+    base = Path(name).stem.lower()
+    if _SLUG_FAST.fullmatch(base):
+        return base
+    base = _SLUG_DASH.sub("-", _SLUG_STRIP.sub("", base)).strip("-_")
     return base or default
 
 def find_stems(stems_dir: Path) -> Dict[str, Optional[str]]:
     paths: Dict[str, Optional[str]] = {k: None for k in STEM_KEYS}
-    wavs = list(stems_dir.glob("*.wav"))
+    # Uma única leitura do diretório, sem stat extra por arquivo
+    with os.scandir(stems_dir) as it:
+        stems = [e for e in it if e.name.lower().endswith(STEM_EXT)]
 
-    for w in wavs:
-        name = w.stem.lower()
+    for e in stems:
+        name = e.name[:-len(STEM_EXT)].lower()
         for key in STEM_KEYS:
             if key in name:
-                paths[key] = str(w)
+                paths[key] = e.path
 
-    if not any(paths.values()) and wavs:
-        wavs_sorted = sorted(wavs)
-        for i, key in enumerate(STEM_KEYS):
-            if i < len(wavs_sorted):
-                paths[key] = str(wavs_sorted[i])
+    if not any(paths.values()):
+        for key, e in zip(STEM_KEYS, sorted(stems, key=lambda e: e.name)):
+            paths[key] = e.path
 
     return paths
 
-def run_demucs(input_path: Path, model_name: str, use_gpu: bool, out_root: Path) -> Path:
+# Modelos carregados uma única vez por processo, indexados por (modelo, device).
+# Um lock por chave: carregar/compilar um modelo não trava a consulta aos já carregados.
+MODELS: Dict[Tuple[str, str], torch.nn.Module] = {}
+_MODEL_LOCKS: Dict[Tuple[str, str], threading.Lock] = {}
+_MODELS_LOCK = threading.Lock()
+
+# torch.compile só na GPU; na CPU o ganho não compensa o tempo de compilação.
+# Se a compilação falhar no aquecimento (ex.: sem Triton), o modelo volta ao modo eager.
+COMPILE_GPU_MODELS = hasattr(torch, "compile")
+
+def resolve_device(use_gpu: bool) -> str:
+    if use_gpu and not torch.cuda.is_available():
+        raise RuntimeError("CUDA não disponível: instale PyTorch com CUDA ou desmarque 'Usar GPU'.")
+    return "cuda" if use_gpu else "cpu"
+
+def compile_model(model: torch.nn.Module) -> torch.nn.Module:
+    # Compila cada submodelo: apply_model precisa continuar vendo o BagOfModels original
+    if isinstance(model, BagOfModels):
+        for i, sub in enumerate(model.models):
+            model.models[i] = torch.compile(sub, mode="reduce-overhead", fullgraph=False)
+        return model
+    return torch.compile(model, mode="reduce-overhead", fullgraph=False)
+
+def uncompile_model(model: torch.nn.Module) -> torch.nn.Module:
+    if isinstance(model, BagOfModels):
+        for i, sub in enumerate(model.models):
+            model.models[i] = getattr(sub, "_orig_mod", sub)
+        return model
+    return getattr(model, "_orig_mod", model)
+
+def load_model(model_name: str, device: str) -> torch.nn.Module:
+    model = pretrained.get_model(model_name)
+    model.to(device).eval()
+    if device == "cuda" and COMPILE_GPU_MODELS:
+        try:
+            model = compile_model(model)
+            warmup_model(model, device)
+        except torch.cuda.OutOfMemoryError:
+            # Nem uma faixa cabe na VRAM: compilar não é o problema, o erro vai para a requisição
+            torch.cuda.empty_cache()
+            logger.warning("VRAM insuficiente para aquecer %s", model_name)
+        except Exception as e:
+            logger.warning("torch.compile falhou para %s, usando o modo eager: %s", model_name, e)
+            model = uncompile_model(model)
+    return model
+
+def get_model(model_name: str, device: str) -> torch.nn.Module:
+    key = (model_name, device)
+    model = MODELS.get(key)
+    if model is not None:
+        return model
+    with _MODELS_LOCK:
+        key_lock = _MODEL_LOCKS.setdefault(key, threading.Lock())
+    with key_lock:
+        model = MODELS.get(key)
+        if model is None:
+            model = MODELS[key] = load_model(model_name, device)
+    return model
+
+def warmup_model(model: torch.nn.Module, device: str, seconds: int = 10):
+    # Compila com silêncio cada tamanho de lote do batcher, para não pesar nas requisições.
+    # Roda no SEPARATE_POOL, a thread da inferência: os CUDA graphs do reduce-overhead são por thread.
+    # Para no primeiro lote que não cabe na VRAM: é falta de memória, não falha de compilação,
+    # e o batcher já refaz esses lotes uma faixa por vez.
+    silence = torch.zeros(model.audio_channels, model.samplerate * seconds)
+    for batch_size in range(1, MAX_BATCH + 1):
+        try:
+            SEPARATE_POOL.submit(apply_separation, model, [silence] * batch_size, device).result()
+        except torch.cuda.OutOfMemoryError:
+            if batch_size == 1:
+                raise
+            torch.cuda.empty_cache()
+            logger.warning("VRAM insuficiente para aquecer lotes de %d faixas", batch_size)
+            break
+
+def autocast_dtype() -> torch.dtype:
+    # BF16 nativo só a partir de Ampere; antes disso (T4, V100) seria emulado, então FP16
+    return torch.bfloat16 if torch.cuda.is_bf16_supported(including_emulation=False) else torch.float16
+
+def prefetch_models():
+    # Baixa os pesos de todos os modelos para o TORCH_HOME e deixa o padrão em memória
+    for model_name in DEMUCS_MODELS:
+        try:
+            pretrained.get_model(model_name)
+        except Exception as e:
+            logger.warning("Não foi possível baixar o modelo %s: %s", model_name, e)
+    get_model("htdemucs", "cpu")
+    if torch.cuda.is_available():
+        get_model("htdemucs", "cuda")  # compila e aquece
+
+def load_track(input_path: Path, model: torch.nn.Module) -> torch.Tensor:
+    # (canais, amostras) já na taxa/canais esperados pelo modelo. Decodifica, reamostra e
+    # converte os canais num único passo do FFmpeg em processo, direto do arquivo original.
+    if StreamReader is not None:
+        try:
+            reader = StreamReader(str(input_path))
+            reader.add_basic_audio_stream(
+                frames_per_chunk=-1,
+                sample_rate=model.samplerate,
+                num_channels=model.audio_channels,
+                format="fltp",
+            )
+            reader.process_all_packets()
+            wav, = reader.pop_chunks()
+            return wav.T.contiguous()
+        except (ImportError, OSError, RuntimeError):
+            pass  # libs do FFmpeg indisponíveis para o torchaudio: usa o ffmpeg do PATH
+    return AudioFile(input_path).read(streams=0, samplerate=model.samplerate, channels=model.audio_channels)
+
+# VRAM de ativação por amostra de entrada nos modelos sem Transformer (Demucs/HDemucs):
+# ~7 GB no segmento padrão de 40 s em estéreo a 44,1 kHz
+ACTIVATION_BYTES_PER_SAMPLE = 2048
+MAX_SEGMENT_HALVINGS = 3
+
+def gpu_segment(model: torch.nn.Module, batch_size: int) -> Optional[float]:
+    # Só os modelos sem Transformer (mdx, mdx_extra) gastam menos VRAM com segmentos menores;
+    # o HTDemucs completa qualquer segmento até o de treino, então fica com o padrão.
+    subs = model.models if isinstance(model, BagOfModels) else [model]
+    if any(isinstance(getattr(sub, "_orig_mod", sub), HTDemucs) for sub in subs):
+        return None
+    free, _total = torch.cuda.mem_get_info()
+    per_second = batch_size * model.audio_channels * model.samplerate * ACTIVATION_BYTES_PER_SAMPLE
+    # Reduz em metades do segmento padrão, para o torch.compile ver poucos formatos diferentes
+    segment = min(float(sub.segment) for sub in subs)
+    for _ in range(MAX_SEGMENT_HALVINGS):
+        if segment * per_second <= free:
+            break
+        segment /= 2
+    return segment
+
+def apply_separation(
+    model: torch.nn.Module, wavs: List[torch.Tensor], device: str, progress: bool = False
+) -> List[torch.Tensor]:
+    # Mesma normalização usada pelo CLI do Demucs, feita por faixa
+    stats = []
+    normed = []
+    for wav in wavs:
+        ref = wav.mean(0)
+        mean, std = ref.mean(), ref.std() + 1e-8
+        stats.append((mean, std))
+        normed.append((wav - mean) / std)
+
+    # Completa com silêncio até o maior comprimento e separa tudo numa chamada só: (B, C, T)
+    max_len = max(w.shape[-1] for w in normed)
+    batch = torch.stack([F.pad(w, (0, max_len - w.shape[-1])) for w in normed])
+    use_amp = device == "cuda"
+    amp_dtype = autocast_dtype() if use_amp else None
+    num_workers = CPU_JOBS if device == "cpu" else 0
+    segment = gpu_segment(model, len(wavs)) if device == "cuda" else None
+    with torch.inference_mode(), torch.autocast("cuda", dtype=amp_dtype, enabled=use_amp):
+        out = apply_model(
+            model, batch, device=device, split=True, overlap=0.25,
+            num_workers=num_workers, segment=segment, progress=progress,
+        )
+    out = out.float()
+
+    return [
+        out[i, ..., :wav.shape[-1]] * std + mean
+        for i, (wav, (mean, std)) in enumerate(zip(wavs, stats))
+    ]
+
+def save_stems(sources: torch.Tensor, model: torch.nn.Module, stems_dir: Path) -> Path:
+    stems_dir.mkdir(parents=True, exist_ok=True)
+    for source, name in zip(sources, model.sources):
+        save_audio(source.cpu(), str(stems_dir / f"{name}{STEM_EXT}"), samplerate=model.samplerate)
+    return stems_dir
+
+def validate_model(model_name: str):
     if model_name not in DEMUCS_MODELS:
         raise ValueError(f"Modelo inválido: {model_name}. Use um destes: {', '.join(DEMUCS_MODELS)}")
 
-    device = "cuda" if use_gpu else "cpu"
-    cmd = ["demucs", "-n", model_name, "-o", str(out_root), "-d", device, str(input_path)]
+def run_demucs(input_path: Path, model_name: str, use_gpu: bool, out_root: Path, progress: bool = False) -> Path:
+    validate_model(model_name)
+    device = resolve_device(use_gpu)
+    # Mantém o layout do CLI: <out_root>/<modelo>/<faixa>/<stem>.flac
+    stems_dir = out_root / model_name / slugify_basename(input_path.name)
 
     try:
-        subprocess.run(cmd, capture_output=True, text=True, check=True)
-    except subprocess.CalledProcessError as e:
-        stderr = (e.stderr or "").strip()
-        hint = []
-        if "argument" in stderr and "--cpu" in stderr:
-            hint.append("A flag --cpu não existe nessa versão. Use -d cpu/cuda.")
-        if "not available" in stderr.lower() and device == "cuda":
-            hint.append("CUDA não disponível: instale PyTorch com CUDA ou use -d cpu.")
-        msg = "Falha ao executar Demucs.\n" + (stderr[-2000:] if stderr else str(e))
-        if hint:
-            msg += "\n\nDicas:\n- " + "\n- ".join(hint)
-        raise RuntimeError(msg)
-
-    model_dir = out_root / model_name
-    if not model_dir.exists():
-        subdirs = [p for p in out_root.iterdir() if p.is_dir()]
-        if not subdirs:
-            raise RuntimeError("Saída do Demucs não encontrada. Verifique logs.")
-        model_dir = subdirs[0]
-
-    children = [p for p in model_dir.iterdir() if p.is_dir()]
-    for child in children:
-        if list(child.glob("*.wav")):
-            return child
-
-    if list(model_dir.glob("*.wav")):
-        return model_dir
-
-    for p in model_dir.rglob("*.wav"):
-        return p.parent
-
-    raise RuntimeError("Pastas/arquivos de stems não encontrados na saída do Demucs.")
+        model = get_model(model_name, device)
+        wav = load_track(input_path, model)
+        # O contexto é copiado para que o gr.Progress(track_tqdm=True) enxergue a barra
+        # do apply_model, que roda na thread do SEPARATE_POOL
+        ctx = contextvars.copy_context()
+        sources, = SEPARATE_POOL.submit(ctx.run, apply_separation, model, [wav], device, progress).result()
+        return save_stems(sources, model, stems_dir)
+    except Exception as e:
+        raise RuntimeError(f"Falha ao executar Demucs.\n{e}") from e
 
 def zip_dir(src_dir: Path, zip_base: Path) -> Path:
-    zip_path = shutil.make_archive(str(zip_base), "zip", root_dir=str(src_dir))
-    return Path(zip_path)
-
-def separate_core(file_path: Path, model_name: str = "htdemucs", use_gpu: bool = False) -> Tuple[Path, Path, Path]:
+    # Stems em FLAC já vêm comprimidos; ZIP_STORED evita gastar CPU com DEFLATE
+    zip_path = zip_base.with_suffix(".zip")
+    with ZipFile(zip_path, "w", ZIP_STORED) as z:
+        for f in sorted(src_dir.iterdir()):
+            if f.is_file():
+                z.write(f, f.name)
+    return zip_path
+
+def check_ffmpeg():
     if not ensure_ffmpeg_in_path():
         raise RuntimeError(
             "FFmpeg não encontrado no PATH. "
             "Instale com 'winget install Gyan.FFmpeg' (ou 'choco install ffmpeg') e reabra o terminal."
         )
 
-    workdir = Path(tempfile.mkdtemp(prefix="demucs_work_"))
-    uploads = workdir / "uploads"
-    outputs = workdir / "separated"
-    uploads.mkdir(parents=True, exist_ok=True)
-    outputs.mkdir(parents=True, exist_ok=True)
-
-    safe_base = slugify_basename(file_path.name, default="input")
-    in_path = uploads / f"{safe_base}.wav"
-    shutil.copyfile(file_path, in_path)
-
-    stems_dir = run_demucs(in_path, model_name, use_gpu, outputs)
-    zip_path = zip_dir(stems_dir, workdir / safe_base)
+def prepare_workdir() -> Path:
+    # A entrada é lida direto do arquivo original; o workdir só guarda a saída
+    root = init_dirs()
+    root.mkdir(mode=0o700, exist_ok=True)
+    workdir = Path(tempfile.mkdtemp(dir=root))
+    with _WORKDIRS_LOCK:
+        _ACTIVE_WORKDIRS.add(workdir)
+    (workdir / "separated").mkdir(parents=True, exist_ok=True)
+    return workdir
+
+def separate_core(
+    file_path: Path, model_name: str = "htdemucs", use_gpu: bool = False, progress: bool = False
+) -> Tuple[Path, Path, Path]:
+    check_ffmpeg()
+    workdir = prepare_workdir()
+    try:
+        stems_dir = run_demucs(file_path, model_name, use_gpu, workdir / "separated", progress=progress)
+        zip_path = zip_dir(stems_dir, workdir / stems_dir.name)
+    except BaseException:
+        release_workdir(workdir)
+        raise
     return Path(zip_path), workdir, stems_dir
 
 def safe_rmtree(path: Path):
@@ -138,6 +342,311 @@ def safe_rmtree(path: Path):
     except Exception:
         pass
 
+# ============================
+# Cache de resultados
+# ============================
+
+# Stems já separados, indexados por <blake3 do upload>_<modelo>. Fica numa pasta da
+# própria aplicação (no /tmp compartilhado outro usuário poderia plantar entradas) e no
+# mesmo volume dos workdirs, para que guardar um resultado seja só criar hardlinks.
+CACHE_DIR = APP_CACHE_DIR / "stems"
+CACHE_MAX_BYTES = 2 << 30  # 2 GiB
+
+def cache_path_for(digest: str, model_name: str) -> Path:
+    return CACHE_DIR / f"{digest}_{model_name}"
+
+def hash_file(path: Path) -> str:
+    # Mesmo hash que o /api/separate calcula durante o upload
+    hasher = blake3.blake3()
+    with open(path, "rb") as f:
+        while chunk := f.read(UPLOAD_CHUNK_SIZE):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def touch_cached(cache_path: Path) -> bool:
+    # Acerto no cache; o mtime é o critério de LRU do janitor
+    try:
+        os.utime(cache_path)
+    except OSError:
+        return False
+    return cache_path.is_dir()
+
+def store_in_cache(stems_dir: Path, cache_path: Path):
+    tmp = Path(tempfile.mkdtemp(prefix=".tmp_", dir=CACHE_DIR))
+    try:
+        for f in stems_dir.iterdir():
+            try:
+                os.link(f, tmp / f.name)
+            except OSError:
+                shutil.copyfile(f, tmp / f.name)
+        tmp.rename(cache_path)
+    except OSError:
+        # Outra requisição já gravou o mesmo resultado (ou o workdir sumiu)
+        safe_rmtree(tmp)
+
+def sweep_cache(max_bytes: int = CACHE_MAX_BYTES):
+    if not CACHE_DIR.is_dir():
+        return
+    entries = []
+    for p in CACHE_DIR.iterdir():
+        try:
+            if p.name.startswith(".tmp_"):
+                if time.time() - p.stat().st_mtime > WORKDIR_TTL:
+                    safe_rmtree(p)
+                continue
+            size = sum(f.stat().st_size for f in p.iterdir())
+            entries.append((p.stat().st_mtime, size, p))
+        except OSError:
+            continue
+
+    # Mantém os mais recentes até o limite e descarta o resto
+    total = 0
+    for _mtime, size, p in sorted(entries, reverse=True):
+        total += size
+        if total > max_bytes:
+            safe_rmtree(p)
+
+# ============================
+# Limpeza de temporários
+# ============================
+
+# Um único janitor varre os workdirs antigos, em vez de um Timer (thread) por requisição.
+# Workdirs ainda em processamento ficam em _ACTIVE_WORKDIRS e nunca são removidos.
+# Cada processo (workers do uvicorn, outras instâncias) cria os seus numa raiz própria;
+# o janitor renova o mtime da sua raiz e só remove as de outros processos abandonadas há muito.
+WORKROOT_PREFIX = "demucs_work_"
+WORKDIR_TTL = 120.0
+WORKROOT_TTL = 24 * 3600.0
+JANITOR_INTERVAL = 30.0
+WORKROOTS_DIR = APP_CACHE_DIR / "work"
+WORK_ROOT: Optional[Path] = None
+
+_ACTIVE_WORKDIRS: Set[Path] = set()
+_WORKDIRS_LOCK = threading.Lock()
+_JANITOR_TASK: Optional[asyncio.Task] = None
+
+def init_dirs() -> Path:
+    # Criados na inicialização e não no import: o módulo importa mesmo sem disco gravável
+    global WORK_ROOT
+    with _WORKDIRS_LOCK:
+        if WORK_ROOT is None:
+            CACHE_DIR.mkdir(mode=0o700, parents=True, exist_ok=True)
+            WORKROOTS_DIR.mkdir(mode=0o700, parents=True, exist_ok=True)
+            WORK_ROOT = Path(tempfile.mkdtemp(prefix=WORKROOT_PREFIX, dir=WORKROOTS_DIR))
+        return WORK_ROOT
+
+def release_workdir(workdir: Path):
+    # Libera o workdir para o janitor, que o remove WORKDIR_TTL segundos depois
+    with _WORKDIRS_LOCK:
+        _ACTIVE_WORKDIRS.discard(workdir)
+    try:
+        os.utime(workdir)
+    except OSError:
+        pass
+
+def discard_workdir(workdir: Path):
+    safe_rmtree(workdir)
+    release_workdir(workdir)
+
+def _expired(path: Path, ttl: float, now: float) -> bool:
+    try:
+        return now - path.stat().st_mtime > ttl
+    except OSError:
+        return False
+
+def sweep_workdirs(ttl: float = WORKDIR_TTL, root_ttl: float = WORKROOT_TTL):
+    if WORK_ROOT is None:
+        return
+    now = time.time()
+    try:
+        os.utime(WORK_ROOT)
+        own = list(WORK_ROOT.iterdir())
+    except OSError:
+        own = []
+    for p in own:
+        with _WORKDIRS_LOCK:
+            if p in _ACTIVE_WORKDIRS:
+                continue
+        if _expired(p, ttl, now):
+            safe_rmtree(p)
+
+    # Sobras de processos que já terminaram
+    for p in WORKROOTS_DIR.glob(f"{WORKROOT_PREFIX}*"):
+        if p != WORK_ROOT and _expired(p, root_ttl, now):
+            safe_rmtree(p)
+
+async def _janitor():
+    while True:
+        await asyncio.sleep(JANITOR_INTERVAL)
+        try:
+            await run_in_threadpool(sweep_workdirs)
+            await run_in_threadpool(sweep_cache)
+        except Exception as e:
+            logger.warning("Falha ao limpar temporários: %s", e)
+
+@app.on_event("startup")
+async def _init_dirs():
+    try:
+        await run_in_threadpool(init_dirs)
+    except OSError as e:
+        logger.warning("Não foi possível criar %s (defina STEMS_CACHE_DIR): %s", APP_CACHE_DIR, e)
+
+@app.on_event("startup")
+async def _start_janitor():
+    global _JANITOR_TASK
+    _JANITOR_TASK = asyncio.create_task(_janitor())
+
+@app.on_event("shutdown")
+async def _stop_janitor():
+    if _JANITOR_TASK is not None:
+        _JANITOR_TASK.cancel()
+    if WORK_ROOT is not None:
+        await run_in_threadpool(safe_rmtree, WORK_ROOT)
+
+# ============================
+# Micro-batching (API)
+# ============================
+
+# Requisições que chegam juntas na API são separadas numa única chamada ao apply_model.
+# Só na GPU: na CPU o apply_model já paraleliza os trechos (CPU_JOBS) e o lote só somaria padding.
+MAX_BATCH = 4
+MAX_WAIT_MS = 100
+# Faixas do mesmo lote são completadas até a maior; só junta durações até 2x diferentes
+MAX_LENGTH_RATIO = 2.0
+
+_BATCH_QUEUE: Optional[asyncio.Queue] = None
+_BATCH_TASK: Optional[asyncio.Task] = None
+
+def split_by_length(group: list) -> List[list]:
+    # Ordena por duração e abre um lote novo quando a faixa passa de MAX_LENGTH_RATIO x a menor do lote
+    group = sorted(group, key=lambda item: item[0].shape[-1])
+    batches = [[group[0]]]
+    for item in group[1:]:
+        if item[0].shape[-1] > batches[-1][0][0].shape[-1] * MAX_LENGTH_RATIO:
+            batches.append([])
+        batches[-1].append(item)
+    return batches
+
+def fail_batch(batch: list, error: Exception):
+    for _, future in batch:
+        if not future.done():
+            future.set_exception(error)
+
+async def run_batch(model_name: str, device: str, batch: list):
+    loop = asyncio.get_running_loop()
+    try:
+        model = await run_in_threadpool(get_model, model_name, device)
+        results = await loop.run_in_executor(
+            SEPARATE_POOL, apply_separation, model, [wav for wav, _ in batch], device
+        )
+    except torch.cuda.OutOfMemoryError as e:
+        if len(batch) == 1:
+            fail_batch(batch, e)
+            return
+        # O lote não coube na VRAM: tenta uma faixa por vez, para não falhar todas juntas
+        torch.cuda.empty_cache()
+        for item in batch:
+            await run_batch(model_name, device, [item])
+        return
+    except Exception as e:
+        fail_batch(batch, e)
+        return
+    for (_, future), sources in zip(batch, results):
+        if not future.done():
+            future.set_result(sources)
+
+async def _batch_worker(queue: asyncio.Queue):
+    loop = asyncio.get_running_loop()
+    while True:
+        items = [await queue.get()]
+        deadline = loop.time() + MAX_WAIT_MS / 1000
+        while len(items) < MAX_BATCH:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                items.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        # Só dá para empilhar entradas do mesmo modelo/device
+        groups: Dict[Tuple[str, str], list] = {}
+        for model_name, device, wav, future in items:
+            if not future.done():
+                groups.setdefault((model_name, device), []).append((wav, future))
+
+        for (model_name, device), group in groups.items():
+            for batch in split_by_length(group):
+                await run_batch(model_name, device, batch)
+
+@app.on_event("startup")
+async def _prefetch_models():
+    try:
+        await run_in_threadpool(prefetch_models)
+    except Exception as e:
+        logger.warning("Falha ao pré-carregar modelos: %s", e)
+
+@app.on_event("startup")
+async def _start_batcher():
+    global _BATCH_QUEUE, _BATCH_TASK
+    _BATCH_QUEUE = asyncio.Queue()
+    _BATCH_TASK = asyncio.create_task(_batch_worker(_BATCH_QUEUE))
+
+async def submit_to_batcher(file_path: Path, model_name: str = "htdemucs", use_gpu: bool = False) -> Tuple[Path, Path]:
+    check_ffmpeg()
+    validate_model(model_name)
+    device = resolve_device(use_gpu)
+
+    workdir = await run_in_threadpool(prepare_workdir)
+    try:
+        model = await run_in_threadpool(get_model, model_name, device)
+        wav = await run_in_threadpool(load_track, file_path, model)
+
+        loop = asyncio.get_running_loop()
+        if device == "cuda":
+            future = loop.create_future()
+            await _BATCH_QUEUE.put((model_name, device, wav, future))
+            sources = await future
+        else:
+            sources, = await loop.run_in_executor(SEPARATE_POOL, apply_separation, model, [wav], device)
+
+        stems_dir = workdir / "separated" / model_name / slugify_basename(file_path.name)
+        await run_in_threadpool(save_stems, sources, model, stems_dir)
+    except BaseException as e:
+        # Sem rmtree aqui para não atrasar a resposta de erro; o janitor remove depois
+        release_workdir(workdir)
+        if isinstance(e, Exception):
+            raise RuntimeError(f"Falha ao executar Demucs.\n{e}") from e
+        raise
+    return workdir, stems_dir
+
+def content_disposition(filename: str) -> str:
+    # Igual ao FileResponse do Starlette: nomes fora do ASCII vão em RFC 5987 (filename*)
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
+def zip_response(src_dir: Path, filename: str) -> StreamingResponse:
+    zs = zip_stream(src_dir)
+    return StreamingResponse(
+        iter(zs),
+        media_type="application/zip",
+        headers={
+            "Content-Disposition": content_disposition(filename),
+            "Content-Length": str(len(zs)),
+        },
+    )
+
+def zip_stream(src_dir: Path) -> ZipStream:
+    # ZIP gerado sob demanda enquanto é enviado, sem arquivo intermediário em disco.
+    # Sem compressão o tamanho final é conhecido antes de gerar o primeiro byte.
+    zs = ZipStream(compress_type=ZIP_STORED, sized=True)
+    for f in sorted(src_dir.iterdir()):
+        if f.is_file():
+            zs.add_path(str(f), f.name)
+    return zs
+
 # ============================
 # FastAPI (API)
 # ============================
@@ -158,38 +667,37 @@ async def api_separate(
     use_gpu: bool = Form(False),
 ):
     suffix = Path(file.filename).suffix or ".wav"
-    tmp_in_dir = Path(tempfile.mkdtemp(prefix="api_in_"))
+    # O upload também fica num workdir: se o processo morrer no meio, o janitor o remove
+    tmp_in_dir = await run_in_threadpool(prepare_workdir)
     tmp_in = tmp_in_dir / f"upload{suffix}"
 
-    workdir: Optional[Path] = None
+    # A limpeza sempre roda depois da resposta (sucesso ou erro), nunca antes dela.
+    # HTTPException descartaria as tasks, por isso os erros viram JSONResponse com background.
+    background_tasks.add_task(discard_workdir, tmp_in_dir)
     try:
-        content = await file.read()
-        tmp_in.write_bytes(content)
-
-        zip_path, workdir, _stems_dir = separate_core(tmp_in, model, use_gpu)
-
-        def _cleanup():
-            safe_rmtree(workdir)
-            safe_rmtree(tmp_in_dir)
-
-        background_tasks.add_task(_cleanup)
-
+        validate_model(model)
         filename = f"{slugify_basename(file.filename)}_{model}_stems.zip"
-        return FileResponse(
-            path=str(zip_path),
-            media_type="application/zip",
-            filename=filename
-        )
+
+        # Copia em blocos para não manter o arquivo inteiro em memória,
+        # calculando o hash do cache no mesmo passo
+        hasher = blake3.blake3()
+        async with aiofiles.open(tmp_in, "wb") as out:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                hasher.update(chunk)
+                await out.write(chunk)
+
+        cache_path = cache_path_for(hasher.hexdigest(), model)
+        if await run_in_threadpool(touch_cached, cache_path):
+            return zip_response(cache_path, filename)
+
+        workdir, stems_dir = await submit_to_batcher(tmp_in, model, use_gpu)
+        background_tasks.add_task(store_in_cache, stems_dir, cache_path)
+        background_tasks.add_task(discard_workdir, workdir)
+        return zip_response(stems_dir, filename)
     except ValueError as ve:
-        safe_rmtree(tmp_in_dir)
-        if workdir:
-            safe_rmtree(workdir)
-        raise HTTPException(status_code=400, detail=str(ve))
+        return JSONResponse({"detail": str(ve)}, status_code=400, background=background_tasks)
     except Exception as e:
-        safe_rmtree(tmp_in_dir)
-        if workdir:
-            safe_rmtree(workdir)
-        raise HTTPException(status_code=500, detail=str(e))
+        return JSONResponse({"detail": str(e)}, status_code=500, background=background_tasks)
 
 @app.get("/api/models")
 def api_models():
@@ -232,7 +740,6 @@ CUSTOM_CSS = """
   border-radius: var(--ds-radius);
   padding:20px;
 }
-.upload-box{ border:1.5px dashed rgba(255,255,255,.18); padding:24px; border-radius: var(--ds-radius); }
 .cta{ display:flex; flex-wrap:wrap; gap: var(--ds-gap); align-items:flex-start; }
 button.primary{ background:var(--ds-primary) !important; color:#0B1020 !important; border-radius: var(--ds-radius-sm) !important; }
 small.helper{ color:var(--ds-text-2); display:block; margin-top:8px; }
@@ -245,18 +752,29 @@ small.helper{ color:var(--ds-text-2); display:block; margin-top:8px; }
 def gradio_workflow(audio_file: Optional[str], model_name: str, use_gpu: bool, progress=gr.Progress(track_tqdm=True)):
     if not audio_file:
         raise gr.Error("Envie um arquivo de áudio.")
+    file_path = Path(audio_file)
     progress(0.1, desc="Preparando…")
+    workdir = None
     try:
-        zip_path, workdir, stems_dir = separate_core(Path(audio_file), model_name, use_gpu)
+        validate_model(model_name)
+        # Mesmo cache da API; o Gradio já roda funções síncronas numa thread, fora do event loop
+        cache_path = cache_path_for(hash_file(file_path), model_name)
+        if touch_cached(cache_path):
+            workdir = prepare_workdir()
+            stems_dir = cache_path
+            zip_path = zip_dir(cache_path, workdir / slugify_basename(file_path.name))
+        else:
+            zip_path, workdir, stems_dir = separate_core(file_path, model_name, use_gpu, progress=True)
+            store_in_cache(stems_dir, cache_path)
         stems = find_stems(stems_dir)
     except Exception as e:
         raise gr.Error(str(e))
+    finally:
+        # O janitor remove o workdir depois de WORKDIR_TTL
+        if workdir is not None:
+            release_workdir(workdir)
     progress(1.0, desc="Pronto!")
 
-    def _cleanup_later():
-        safe_rmtree(workdir)
-    threading.Timer(120.0, _cleanup_later).start()
-
     return stems["vocals"], stems["drums"], stems["bass"], stems["other"], str(zip_path)
 
 with gr.Blocks(theme=THEME, css=CUSTOM_CSS, title="Separar voz e instrumentos (stems) – DevSounds") as demo:
@@ -275,12 +793,17 @@ with gr.Blocks(theme=THEME, css=CUSTOM_CSS, title="Separar voz e instrumentos (s
     with gr.Group(elem_classes="card"):
         gr.Markdown("## Extraia vozes e instrumentos\nArraste seu arquivo ou clique para enviar. Depois, escolha o modelo e clique em **Separar**.")
         with gr.Row(elem_classes="cta"):
-            audio_input = gr.Audio(type="filepath", label="Áudio (mp3/wav/flac)", elem_classes="upload-box")
+            # gr.File entrega o arquivo original, sem a recodificação para WAV do gr.Audio
+            audio_input = gr.File(
+                label="Áudio (mp3/wav/flac/m4a)",
+                type="filepath",
+                file_types=[".mp3", ".wav", ".flac", ".m4a"],
+            )
             with gr.Column():
                 model_dropdown = gr.Dropdown(choices=DEMUCS_MODELS, value="htdemucs", label="Modelo")
                 use_gpu = gr.Checkbox(value=False, label="Usar GPU (CUDA)", info="Marque se tiver NVIDIA + CUDA configurado")
                 run_btn = gr.Button("Separar", elem_classes="primary")
-                gr.HTML('<small class="helper">Formatos: mp3, wav, flac. Arquivos temporários são removidos automaticamente após o processamento.</small>')
+                gr.HTML('<small class="helper">Formatos: mp3, wav, flac, m4a. Arquivos temporários são removidos automaticamente após o processamento.</small>')
 
     # Resultados (Tabs)
     gr.Markdown("### 🎧 Stems")
@@ -339,7 +862,8 @@ with gr.Blocks(theme=THEME, css=CUSTOM_CSS, title="Separar voz e instrumentos (s
     )
 
 # >>> Monte o Gradio em /app (não na raiz)
-gr.mount_gradio_app(app, demo, path="/app")
+# Os stems (workdirs e cache) ficam em APP_CACHE_DIR, fora do temp que o Gradio já libera
+gr.mount_gradio_app(app, demo, path="/app", allowed_paths=[str(APP_CACHE_DIR)])
 
 # >>> Página estática em / com OG/Twitter (scrapers não rodam JS)
 @app.get("/", response_class=HTMLResponse)